@@ -8,17 +8,52 @@ import coloredlogs
 import sys
 import os
 import json
+import fcntl
+import functools
+import math
+import pathlib
+import re
+import selectors
+from dataclasses import dataclass
 import numpy as np
-from subprocess import Popen, PIPE
-from threading import Thread, Event
+from subprocess import Popen, PIPE, run
+from concurrent.futures import ThreadPoolExecutor
 import astropy.units as u
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 log = logging.getLogger('capture_data')
 MAX_FFT_LENGTH = 1<<28
+HZ = u.Hz
+SECOND = u.s
+_UNIT_CACHE = {}
+OUTPUT_UID = 1000  # rfiops
+OUTPUT_GID = 1000
 DADA_BLOCK_SIZE = 1073741824#8589934592
 DADA_NBLOCKS = 12
 DADA_KEY = "dada"
+SPECTROMETER_GPU = "0"
+SPECTROMETER_CPUS = frozenset([9])
+MKRECV_CPUS = frozenset(range(0, 9))
+PIPE_BUFFER_SIZE = 1<<20
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+# Status reporting: ESE bits 2-5 are the query, device dependent,
+# execution and command errors; STB bit 2 is the R&S error queue
+# and bit 5 the event status summary
+ESE_ERROR_MASK = 0x3c
+STB_ERROR_MASK = 0x24
+VISA_TIMEOUT = 30000  # ms
+VISA_CHUNK_SIZE = 1<<20
+SCPI_MAX_CHAIN_LENGTH = 1024  # bytes per compound command
+CONFIG_CACHE_SUFFIX = ".cache.json"
 MKRECV_FILE_PATH = "/tmp/mkrecv.cfg"
+MKRECV_SHUTDOWN_TIMEOUT = 5.0  # seconds
 MKRECV_CONF_PFB_MODE = """
 HEADER       DADA                # Distributed aquisition and data analysis
 HDR_VERSION  1.0                 # Version of this ASCII header
@@ -90,6 +125,10 @@ IDX1_ITEM   0         # First item of a SPEAD heap
 IDX1_STEP   1   # The difference between successive timestamps
 """
 
+# Pre-encoded so write_if_changed can compare and write the header as bytes
+_MKRECV_CONF_PFB_MODE_BYTES = MKRECV_CONF_PFB_MODE.encode()
+_MKRECV_CONF_PASSTHROUGH_MODE_BYTES = MKRECV_CONF_PASSTHROUGH_MODE.encode()
+
 
 class SpectrumAnalyserException(Exception):
     pass
@@ -99,73 +138,210 @@ class DataOutOfRangeException(Exception):
     pass
 
 
-class PipeHandler(Thread):
-    def __init__(self, pipe):
-        Thread.__init__(self)
-        self._pipe = pipe
-        self._stop_event = Event()
-        self.setDaemon(True)
-        self.start()
+class PipeHandler(object):
+    READ_SIZE = 1 << 16
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def __call__(self, pipe):
+        # os.read returns whatever is currently in the pipe (up to
+        # READ_SIZE) so a burst of lines is consumed in one syscall,
+        # False is returned once the pipe has reached EOF
+        try:
+            chunk = os.read(pipe.fileno(), self.READ_SIZE)
+        except BlockingIOError:
+            return True
+        if not chunk:
+            # A final line without a newline is still handled
+            if self._buf:
+                lines, self._buf = [bytes(self._buf)], bytearray()
+                self.handle_lines(lines)
+            return False
+        self._buf.extend(chunk)
+        end = self._buf.rfind(b"\n")
+        if end != -1:
+            lines = bytes(self._buf[:end]).split(b"\n")
+            del self._buf[:end + 1]
+            self.handle_lines(lines)
+        return True
+
+
+class PipeMux(object):
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+
+    def register(self, pipe, handler):
+        self._selector.register(pipe, selectors.EVENT_READ, handler)
+
+    def _service(self, timeout):
+        for key, _ in self._selector.select(timeout=timeout):
+            if not key.data(key.fileobj):
+                self._selector.unregister(key.fileobj)
+
+    def run_until(self, proc, poll_interval=0.1):
+        while proc.poll() is None:
+            self._service(poll_interval)
 
-    def stop(self):
-        self._stop_event.set()
-        self.join()
+    def drain(self, timeout=5.0, poll_interval=0.1):
+        # Returns False if some pipes were still open after timeout seconds
+        deadline = time.monotonic() + timeout
+        while self._selector.get_map():
+            if time.monotonic() > deadline:
+                return False
+            self._service(poll_interval)
+        return True
+
+    def close(self):
+        self._selector.close()
 
 
 class MKRECVStdoutHandler(PipeHandler):
-    def __init__(self, pipe, nskip):
+    _STAT_RE = re.compile(rb"^STAT\s+(\d+)\s+\S+\s+(\d+)")
+
+    def __init__(self, nskip):
         self._nskip = nskip
-        PipeHandler.__init__(self, pipe)
+        PipeHandler.__init__(self)
 
-    def parse_stat_line(self, line):
-        sp = line.split()
-        total_slots = int(sp[1])
-        filled_slots = int(sp[3])
+    def parse_stat_line(self, match):
+        total_slots = int(match.group(1))
+        filled_slots = int(match.group(2))
         if total_slots != filled_slots:
             lost_fraction = 1 - float(filled_slots) / total_slots
-            log.warning(("Packet loss detected in network capture ({:0.06f}% loss) "
-                         "consider repeating this measurement").format(
-                         100.0 * lost_fraction))
-
-    def run(self):
-        while not self._stop_event.is_set():
-            line = self._pipe.readline()
-            log.debug("{}".format(line))
-            if line.startswith(b"STAT"):
-                self._nskip -= 1
-                if self._nskip > 0:
-                    continue
-                else:
-                    self.parse_stat_line(line)
+            log.warning("Packet loss detected in network capture (%0.06f%% loss) "
+                        "consider repeating this measurement",
+                        100.0 * lost_fraction)
+
+    def handle_lines(self, lines):
+        for line in lines:
+            log.debug("%s", line)
+            match = self._STAT_RE.match(line)
+            if match is None:
+                continue
+            self._nskip -= 1
+            if self._nskip <= 0:
+                self.parse_stat_line(match)
 
 
 class RSSpectrometerStdoutHandler(PipeHandler):
-    def __init__(self, pipe):
-        PipeHandler.__init__(self, pipe)
+    _LVL_RE = re.compile(rb"\[(info|warning|error)\]")
+    _LEVELS = {
+        b"info": logging.INFO,
+        b"warning": logging.WARNING,
+        b"error": logging.ERROR
+    }
 
-    def run(self):
-        while not self._stop_event.is_set():
-            line = self._pipe.readline()
-            log.debug("{}".format(line))
-            if b"[info]" in line:
-                log.info(line.decode().strip("\n"))
-            elif b"[error]" in line:
-                log.error(line.decode().strip("\n"))
+    def __init__(self):
+        PipeHandler.__init__(self)
+
+    def handle_lines(self, lines):
+        # Consecutive lines of the same level are joined into a single
+        # log record so the logger lock is taken once per run of lines
+        # rather than once per line
+        batch = []
+        batch_level = None
+        for line in lines:
+            match = self._LVL_RE.search(line)
+            if match is None:
+                log.debug("%s", line)
+                continue
+            level = self._LEVELS[match.group(1)]
+            if not log.isEnabledFor(level):
+                continue
+            if level != batch_level and batch:
+                log.log(batch_level, "\n".join(batch))
+                batch = []
+            batch_level = level
+            batch.append(line.rstrip(b"\r\n").decode("ascii", "replace"))
+        if batch:
+            log.log(batch_level, "\n".join(batch))
+
+
+def is_chainable(command):
+    # Queries, *WAI/*OPC and '@' pseudo commands are sent on their own
+    command = command.strip()
+    if "?" in command or command.startswith("@"):
+        return False
+    return command.upper() not in ("*WAI", "*OPC")
+
+
+def chain_commands(commands):
+    # A command following ';' is relative to the previous command's
+    # header unless it starts from the root, so make every header absolute
+    return ";".join(
+        command if command.startswith((":", "*")) else ":" + command
+        for command in (command.strip() for command in commands))
+
+
+@functools.lru_cache(maxsize=None)
+def get_resource_manager():
+    return pyvisa.ResourceManager()
+
+
+def _cached(query):
+    # Memoise a query until the next command is sent
+    @functools.wraps(query)
+    def wrapper(self):
+        try:
+            return self._cache[query.__name__]
+        except KeyError:
+            value = self._cache[query.__name__] = query(self)
+            return value
+    return wrapper
 
 
 class SpectrumAnalyserInterface(object):
+    # Frequencies and rates are returned in Hz, the reference level in dBm
     def __init__(self, visa_resource, passive=False):
         self._visa_resource = visa_resource
         self._passive = passive
-        self._rm = pyvisa.ResourceManager()
+        self._cache = {}
+        self._rm = get_resource_manager()
+        self._interface = None
         self.reconnect()
 
     def reconnect(self):
+        self._cache.clear()
+        # Release the previous session so repeated reconnects do not
+        # leak VISA sessions or TCP connections to the analyser
+        if self._interface is not None:
+            try:
+                self._interface.close()
+            except pyvisa.errors.VisaIOError:
+                log.debug("Failed to close VISA resource %s",
+                          self._visa_resource)
         self._interface = self._rm.open_resource(
             self._visa_resource)
+        self._interface.timeout = VISA_TIMEOUT
+        self._interface.chunk_size = VISA_CHUNK_SIZE
+        self._interface.read_termination = "\n"
+        self._interface.write_termination = "\n"
+        try:
+            self._interface.set_visa_attribute(
+                pyvisa.constants.VI_ATTR_TCPIP_KEEPALIVE, True)
+        except (pyvisa.errors.VisaIOError, NotImplementedError, ValueError):
+            log.debug("TCPIP keep-alive not supported by VISA resource %s",
+                      self._visa_resource)
+
+    def enable_error_reporting(self):
+        # Any command, execution, device or query error raises the event
+        # summary bit in the status byte
+        self.send_command("*ESE {};*CLS".format(ESE_ERROR_MASK))
 
     def check_error(self):
+        # The status byte is a single byte round trip, the error queue
+        # is only read when the status byte reports an error
+        if int(self._interface.query("*STB?")) & STB_ERROR_MASK:
+            self.read_errors()
+
+    def read_errors(self):
         msg = self._interface.query(":SYST:ERR:ALL?")
+        # Reading the event status register clears it and with it the
+        # event summary bit of the status byte
+        self._interface.query("*ESR?")
+        self.raise_for_error(msg)
+
+    def raise_for_error(self, msg):
         retval = int(msg.split(",")[0])
         if retval == 0:
             return
@@ -178,158 +354,397 @@ class SpectrumAnalyserInterface(object):
                     msg)))
 
     def send_command(self, command):
+        # Any command may change the analyser state (e.g. the sampling
+        # rate or reference level) so all cached query results are dropped
+        self._cache.clear()
         if not self._passive:
-            log.debug("Sending SCPI command: {}".format(command))
+            log.debug("Sending SCPI command: %s", command)
             self._interface.write(command)
 
     def send_commands(self, commands):
+        # Runs of plain settings are chained into a single compound
+        # command so that each run costs one write to the analyser,
+        # long runs are split to stay within the analyser input buffer
+        chain = []
+        chain_length = 0
         for command in commands:
+            if is_chainable(command):
+                if chain and chain_length + len(command) + 2 > SCPI_MAX_CHAIN_LENGTH:
+                    self.send_command(chain_commands(chain))
+                    chain = []
+                    chain_length = 0
+                chain.append(command)
+                chain_length += len(command) + 2
+                continue
+            if chain:
+                self.send_command(chain_commands(chain))
+                chain = []
+                chain_length = 0
             self.send_command(command)
+        if chain:
+            self.send_command(chain_commands(chain))
         self.check_error()
 
+    @_cached
     def get_analysis_bandwidth(self):
-        return float(self._interface.query(":TRAC:IQ:BWID?")) * u.Hz
+        return float(self._interface.query(":TRAC:IQ:BWID?"))
 
+    @_cached
     def get_sampling_rate(self):
-        return float(self._interface.query(":TRAC:IQ:SRAT?")) * u.Hz
+        return float(self._interface.query(":TRAC:IQ:SRAT?"))
+
+    def query_batch(self, commands):
+        # Only the last query may return a response containing ';'
+        command = chain_commands(commands)
+        nqueries = sum(1 for cmd in commands if "?" in cmd)
+        log.debug("Sending SCPI query: %s", command)
+        responses = self._interface.query(command).split(";", nqueries - 1)
+        if len(responses) != nqueries:
+            raise SpectrumAnalyserException(
+                "Expected {} responses to '{}', received: {}".format(
+                    nqueries, command, ";".join(responses)))
+        return responses
 
     def set_centre_frequency(self, frequency):
-        self.send_command(":SENS:FREQ:CENT {}".format(str(frequency)))
-        self.check_error()
-
+        # Setting, reading back and error checking the centre frequency
+        # are done in a single round trip, the read back value is kept
+        # for get_centre_frequency
+        self._cache.clear()
+        commands = [":SENS:FREQ:CENT?", "*STB?"]
+        if not self._passive:
+            commands.insert(0, ":SENS:FREQ:CENT {}".format(str(frequency)))
+        actual_frequency, stb = self.query_batch(commands)
+        if int(stb) & STB_ERROR_MASK:
+            self.read_errors()
+        self._cache["get_centre_frequency"] = float(actual_frequency)
+
+    def get_acquisition_settings(self):
+        srate, bwid, rlev = self.query_batch([
+            ":TRAC:IQ:SRAT?",
+            ":TRAC:IQ:BWID?",
+            ":DISP:WIND:SUBW:TRAC:Y:SCAL:RLEV?"])
+        self._cache["get_sampling_rate"] = float(srate)
+        self._cache["get_analysis_bandwidth"] = float(bwid)
+        self._cache["get_scaling"] = float(rlev)
+        return (self.get_sampling_rate(),
+                self.get_analysis_bandwidth(),
+                self.get_scaling())
+
+    @_cached
     def get_centre_frequency(self):
-        return float(self._interface.query(":SENS:FREQ:CENT?")) * u.Hz
+        return float(self._interface.query(":SENS:FREQ:CENT?"))
 
+    @_cached
     def get_scaling(self):
         return float(self._interface.query(
-            "DISP:WIND:SUBW:TRAC:Y:SCAL:RLEV?")) * u.dB(u.mW)
+            "DISP:WIND:SUBW:TRAC:Y:SCAL:RLEV?"))
+
+
+def get_unit(name):
+    try:
+        return _UNIT_CACHE[name]
+    except KeyError:
+        pass
+    try:
+        unit = getattr(u, name)
+    except AttributeError:
+        raise ValueError("Unknown unit in configuration: '{}'".format(name))
+    _UNIT_CACHE[name] = unit
+    return unit
+
+
+def to_si(value, units, si_unit):
+    return float(units.to(si_unit, value))
+
+
+@dataclass(frozen=True)
+class MeasurementPlan:
+    channel_bandwidth_hz: float
+    fft_length: int
+    naccumulate: int
+    total_nchans: int
+    actual_resolution_hz: float
+    actual_integration_time_s: float
+
+
+@functools.lru_cache(maxsize=16)
+def plan_measurement(sampling_rate_hz, first_stage_nchans,
+                     resolution_hz, integration_time_s):
+    channel_bandwidth_hz = sampling_rate_hz / first_stage_nchans
+    fft_length = int(channel_bandwidth_hz / resolution_hz)
+    if fft_length < 1:
+        message = "Resolution is coarser than the first stage channel bandwidth ({} Hz)".format(
+            channel_bandwidth_hz)
+        log.error(message)
+        raise Exception(message)
+    # Round FFT length to next power of 2 so that whole FFT frames
+    # tile the power of 2 DADA blocks
+    fft_length = 1 << (fft_length - 1).bit_length()
+    if fft_length > MAX_FFT_LENGTH:
+        message = "Resolution exceeds maximum FFT length ({} pts)".format(MAX_FFT_LENGTH)
+        log.error(message)
+        raise Exception(message)
+    actual_resolution_hz = channel_bandwidth_hz / fft_length
+    # The number of spectra is rounded up to the next whole number
+    naccumulate = math.ceil(integration_time_s * actual_resolution_hz)
+    return MeasurementPlan(
+        channel_bandwidth_hz=channel_bandwidth_hz,
+        fft_length=fft_length,
+        naccumulate=naccumulate,
+        total_nchans=first_stage_nchans * fft_length,
+        actual_resolution_hz=actual_resolution_hz,
+        actual_integration_time_s=naccumulate / actual_resolution_hz)
 
 
 class Measurement(object):
     def __init__(self, config):
         self._tag = config["userTag"]
         self._scpi_commands = config["spectrumAnalyserScpi"]
+        # Quantities are converted to plain floats in SI units here so
+        # that no unit arithmetic is needed while planning and sweeping
         fconfig = config["frequencyRange"]
-        units = getattr(u, fconfig["units"])
-        self._frequency_start = fconfig["start"] * units
-        self._frequency_end = fconfig["end"] * units
+        units = get_unit(fconfig["units"])
+        self._frequency_start_hz = to_si(fconfig["start"], units, HZ)
+        self._frequency_end_hz = to_si(fconfig["end"], units, HZ)
         sconfig = config["spectrometerParams"]
-        units = getattr(u, sconfig["resolutionUnits"])
-        self._resolution = sconfig["resolution"] * units
-        units = getattr(u, sconfig["integrationTimeUnits"])
-        self._integration_time = sconfig["integrationTime"] * units
-        self._output_path = sconfig["outputPath"]
-
-    def get_centre_frequencies(self, bandwidth):
-        centre_freqs = []
-        frequency = self._frequency_start
-        frequency = frequency + bandwidth/2
-        centre_freqs.append(frequency)
-        while True:
-            if frequency + bandwidth/2 > self._frequency_end:
-                break
-            frequency = frequency + bandwidth
-            centre_freqs.append(frequency)
-        return centre_freqs
+        units = get_unit(sconfig["resolutionUnits"])
+        self._resolution_hz = to_si(sconfig["resolution"], units, HZ)
+        units = get_unit(sconfig["integrationTimeUnits"])
+        self._integration_time_s = to_si(sconfig["integrationTime"], units, SECOND)
+        # The output path is created up front so that a missing directory
+        # is reported before any hardware is configured
+        self._output_path = pathlib.Path(sconfig["outputPath"])
+        self._output_path.mkdir(parents=True, exist_ok=True)
+
+    def plan(self, sampling_rate_hz, first_stage_nchans):
+        return plan_measurement(sampling_rate_hz, first_stage_nchans,
+                                self._resolution_hz, self._integration_time_s)
+
+    def get_centre_frequencies(self, bandwidth_hz):
+        # Blocks are placed back to back from the start frequency and a
+        # new block is added for as long as the previous one ends at or
+        # below the end frequency, so the last block may overhang it.
+        start = self._frequency_start_hz
+        end = self._frequency_end_hz
+        bw = bandwidth_hz
+        if bw <= 0:
+            raise ValueError("Invalid analysis bandwidth: {} Hz".format(bandwidth_hz))
+        # The small tolerance stops a span that is an exact multiple of
+        # the bandwidth losing its last block to floating point rounding
+        nblocks = max(0, math.floor((end - start) / bw + 1e-9)) + 1
+        return start + bw / 2 + np.arange(nblocks) * bw
+
+
+def dump_json(obj):
+    # orjson writes NaN and Inf as null, so headers holding them go
+    # through the json module to give the same output with or without it
+    if orjson is not None and not any(
+            isinstance(value, float) and not math.isfinite(value)
+            for value in obj.values()):
+        # Non-str keys are converted to strings as the json module does
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj).encode()
 
 
 def syscmd_wrapper(cmd):
-    proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    if proc.wait() != 0:
-        stdout = proc.stdout.read()
-        stderr = proc.stderr.read()
+    # run() drains stdout and stderr while waiting, so a command writing
+    # more than a pipe buffer of output cannot deadlock
+    result = run(cmd, stdout=PIPE, stderr=PIPE)
+    if result.returncode != 0:
         raise Exception("Command: '{}' failed\nstdout: {}\nstderr: {}".format(
-            " ".join(cmd), stdout, stderr))
+            " ".join(cmd),
+            result.stdout.decode(errors="replace"),
+            result.stderr.decode(errors="replace")))
+
+
+def write_if_changed(fname, data):
+    try:
+        with open(fname, "rb") as f:
+            if f.read(len(data) + 1) == data:
+                return
+    except FileNotFoundError:
+        pass
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+def monitor_pipe():
+    # The read end is non-blocking with an enlarged kernel buffer, the
+    # write end is a raw fd for Popen that the caller must close
+    read_fd, write_fd = os.pipe2(os.O_CLOEXEC)
+    os.set_blocking(read_fd, False)
+    try:
+        fcntl.fcntl(read_fd, F_SETPIPE_SZ, PIPE_BUFFER_SIZE)
+    except OSError as error:
+        log.debug("Unable to resize monitor pipe: %s", error)
+    return os.fdopen(read_fd, "rb", 0), write_fd
+
+
+def pin_to_cpus(cpus):
+    def preexec():
+        os.sched_setaffinity(0, cpus)
+    return preexec
 
 
 class Spectrometer(object):
-    def __init__(self):
+    def __init__(self, network_config=None):
         self._mkrecv_proc = None
         self._spec_proc = None
         self._nskip = 4
+        self._network_config = network_config or {}
+        self._network_tuned = False
+        self._dada_allocated = None
+        self._teardown_pool = ThreadPoolExecutor(max_workers=1)
+        self._teardown = None
+
+    def tune_network(self):
+        # Best effort, failures are logged and the host defaults are kept
+        nconfig = self._network_config
+        interface = nconfig.get("interface", "ens1f0")
+        irq_cpus = str(nconfig.get("irqCpus", "10-15"))
+        log.info("Pinning %s interrupts to CPUs %s", interface, irq_cpus)
+        irq_dir = "/sys/class/net/{}/device/msi_irqs".format(interface)
+        try:
+            irqs = os.listdir(irq_dir)
+        except OSError as error:
+            log.warning("Unable to list interrupts for %s: %s",
+                        interface, error)
+            irqs = []
+        for irq in irqs:
+            try:
+                with open("/proc/irq/{}/smp_affinity_list".format(irq), "w") as f:
+                    f.write(irq_cpus)
+            except OSError as error:
+                log.warning("Unable to set affinity of IRQ %s: %s",
+                            irq, error)
+        for cmd in (
+                ["ethtool", "-C", interface,
+                 "adaptive-rx", "off",
+                 "rx-usecs", str(nconfig.get("rxUsecs", 8))],
+                ["sysctl", "-w", "net.core.busy_poll={}".format(
+                    nconfig.get("busyPoll", 50))]):
+            try:
+                syscmd_wrapper(cmd)
+            except Exception as error:
+                log.warning("Network tuning command failed: %s", error)
 
-    def configure(self):
-        """
+    def ensure_buffer(self, block_size, nblocks):
+        if self._dada_allocated == (block_size, nblocks):
+            return
         # Destroy any previous DADA buffers
         log.debug("Cleaning up any previous DADA buffers")
         try:
-            syscmd_wrapper(["taskset", "-c", "10-19", "dada_db", "-k", DADA_KEY, "-d"])
+            syscmd_wrapper(["taskset", "-c", "0-9", "dada_db", "-k", DADA_KEY, "-d"])
         except Exception as e:
             pass
 
         # Create new DADA buffer
         log.debug("Allocating DADA buffer")
-        syscmd_wrapper(["taskset", "-c", "10-19", "dada_db",
+        syscmd_wrapper(["taskset", "-c", "0-9", "dada_db",
                         "-k", DADA_KEY,
-                        "-b", str(DADA_BLOCK_SIZE),
-                        "-n", str(DADA_NBLOCKS),
+                        "-b", str(block_size),
+                        "-n", str(nblocks),
                         "-l", "-p"])
-        """
-        
+        self._dada_allocated = (block_size, nblocks)
+
+    def configure(self):
+        self.ensure_buffer(DADA_BLOCK_SIZE, DADA_NBLOCKS)
+        if self._network_config.get("tuneInterface") and not self._network_tuned:
+            self.tune_network()
+            self._network_tuned = True
+
+    def wait_idle(self):
+        if self._teardown is None:
+            return
+        (output_file, teardown), self._teardown = self._teardown, None
+        try:
+            teardown.result()
+        except Exception as error:
+            # The buffer state is unknown after a failed teardown so it
+            # is reallocated before the next recording
+            log.error("Teardown of recording %s failed: %s", output_file, error)
+            self._dada_allocated = None
+
+    def close(self):
+        self.wait_idle()
+        self._teardown_pool.shutdown()
+        if self._dada_allocated:
+            log.debug("Destroying DADA buffer")
+            try:
+                syscmd_wrapper(["taskset", "-c", "0-9", "dada_db", "-k", DADA_KEY, "-d"])
+            except Exception as error:
+                log.warning("Unable to destroy DADA buffer: %s", error)
+            self._dada_allocated = None
 
     def record(self, input_nchans, fft_length, naccumulate, output_file, reference_level):
+        if input_nchans == 1:
+            log.info("Assuming PASSTHROUGH mode on FPGA")
+            header = _MKRECV_CONF_PASSTHROUGH_MODE_BYTES
+        else:
+            log.info("Assuming PFB mode on FPGA")
+            header = _MKRECV_CONF_PFB_MODE_BYTES
+        self.wait_idle()
+        self.configure()
         log.debug("Writing MKRECV header file")
-        with open(MKRECV_FILE_PATH, "w") as f:
-            if input_nchans == 1:
-                log.info("Assuming PASSTHROUGH mode on FPGA")
-                f.write(MKRECV_CONF_PASSTHROUGH_MODE)
-            else:
-                log.info("Assuming PFB mode on FPGA")
-                f.write(MKRECV_CONF_PFB_MODE)
-        #log.debug("Reseting DADA buffer")
-        #syscmd_wrapper(["taskset", "-c", "10-19", "dbreset", "-k", DADA_KEY])
-        
-        
-        # Destroy any previous DADA buffers
-        log.debug("Cleaning up any previous DADA buffers")
-        try:
-            syscmd_wrapper(["taskset", "-c", "0-9", "dada_db", "-k", DADA_KEY, "-d"])
-        except Exception as e:
-            pass
+        write_if_changed(MKRECV_FILE_PATH, header)
 
-        # Create new DADA buffer
-        log.debug("Allocating DADA buffer")
-        syscmd_wrapper(["taskset", "-c", "0-9", "dada_db",
-                        "-k", DADA_KEY,
-                        "-b", str(DADA_BLOCK_SIZE),
-                        "-n", str(DADA_NBLOCKS),
-                        "-l", "-p"])
-        
         log.debug("Starting spectrometer")
-        os.environ["CUDA_VISIBLE_DEVICES"] = "0"
-        
+        spec_env = os.environ.copy()
+        spec_env["CUDA_VISIBLE_DEVICES"] = SPECTROMETER_GPU
         self._spec_proc = Popen([
-            "taskset", "-c", "9",
             "rsspectrometer",
             "--key", DADA_KEY,
             "--input-nchans", str(input_nchans),
             "--fft-length", str(fft_length),
             "--naccumulate", str(naccumulate),
-            "--reflevel", str(reference_level.value),
+            "--reflevel", str(reference_level),
             "--nskip", str(self._nskip),
             "-o", output_file,
             "--log-level", "info"],
-            stdout=sys.stdout, stderr=sys.stderr, bufsize=1)
-        
-        #self._spec_proc = Popen(["dbnull"])
+            stdout=sys.stdout, stderr=sys.stderr, env=spec_env,
+            preexec_fn=pin_to_cpus(SPECTROMETER_CPUS))
         log.debug("Starting mkrecv")
+        mkrecv_stdout, mkrecv_stdout_w = monitor_pipe()
         self._mkrecv_proc = Popen([
-            "taskset", "-c", "0-8",
             "mkrecv_rnt", "--header", MKRECV_FILE_PATH,
             "--slots-skip","4","--quiet"],
-            stdout=PIPE, stderr=sys.stderr, bufsize=1)
-        mkrecv_monitor = MKRECVStdoutHandler(self._mkrecv_proc.stdout, self._nskip)
-        #rs_monitor = RSSpectrometerStdoutHandler(self._spec_proc.stdout)
-        self._spec_proc.wait()
+            stdout=mkrecv_stdout_w, stderr=sys.stderr,
+            preexec_fn=pin_to_cpus(MKRECV_CPUS))
+        os.close(mkrecv_stdout_w)
+        mux = PipeMux()
+        mux.register(mkrecv_stdout, MKRECVStdoutHandler(self._nskip))
+        #mux.register(self._spec_proc.stdout, RSSpectrometerStdoutHandler())
+        mux.run_until(self._spec_proc)
+        # The recording is complete once the spectrometer has exited, the
+        # capture is shut down in the background so that the caller can
+        # retune the analyser in the meantime
+        self._teardown = (output_file, self._teardown_pool.submit(
+            self._finish_recording, mux, mkrecv_stdout))
+
+    def _finish_recording(self, mux, mkrecv_stdout):
         self._mkrecv_proc.terminate()
-        mkrecv_monitor.stop()
-        #rs_monitor.stop()
+        # Handle the output mkrecv produced before exiting and only
+        # release the pipe once it has been closed from the other end
+        if not mux.drain(timeout=MKRECV_SHUTDOWN_TIMEOUT):
+            log.warning("mkrecv did not exit after terminate, killing it")
+            self._mkrecv_proc.kill()
+        self._mkrecv_proc.wait()
+        mux.close()
+        mkrecv_stdout.close()
+        # The buffer is allocated once in configure() and only reset
+        # between recordings
+        log.debug("Reseting DADA buffer")
+        syscmd_wrapper(["taskset", "-c", "0-9", "dbreset", "-k", DADA_KEY])
 
 
 class Executor(object):
     def __init__(self, config, dry_run=False):
         self._config = config
         self._dry_run = dry_run
+        self._spectrometer = None
         self._start_interface()
 
     def _start_interface(self):
@@ -341,157 +756,209 @@ class Executor(object):
 
     def init(self):
         log.info("Initialising spectrum analyser")
+        self._interface.enable_error_reporting()
         self._interface.send_commands(
             self._config["spectrumAnalyser"]["scpiCommands"])
 
-    def write_header(self, fname, cfreq, bw, total_nchans,
-                     integration_time, timestamp, tag):
-        # read analysis band:
-        abw = self._interface.get_analysis_bandwidth()
+    def write_header(self, fname, cfreq_hz, bw_hz, abw_hz, total_nchans,
+                     integration_time_ms, timestamp, tag):
         header_dict = {
-            "Center Frequency in Hz": cfreq.to(u.Hz).value,
-            "Analysis Center Frequency in Hz":cfreq.to(u.Hz).value,
-            "Bandwidth in Hz": bw.to(u.Hz).value,
-            "Analysis Bandwidth in Hz":abw.to(u.Hz).value,
-            "Center Frequency in Hz":cfreq.to(u.Hz).value,
-            "Bandwidth in Hz":bw.to(u.Hz).value,
+            "Center Frequency in Hz": cfreq_hz,
+            "Analysis Center Frequency in Hz": cfreq_hz,
+            "Bandwidth in Hz": bw_hz,
+            "Analysis Bandwidth in Hz": abw_hz,
             "Number of Channels": total_nchans,
             "Frequency Spacing": "uniform",
-            "Integration time in milliseconds": integration_time.to(u.ms).value,
+            "Integration time in milliseconds": integration_time_ms,
             "Unique Scan ID": fname.split("/")[-1].strip(".rfi"),
             "Timestamp": timestamp,
             "User Friendly Name": tag
 
         }
         for param in self._config["headerInformation"]:
-            header_dict[param["key"]] = param["value"]
-        with open(fname, "w") as f:
-            json.dump(header_dict, f)
+            header_dict[str(param["key"])] = param["value"]
+        # Serialised up front so that a header which cannot be encoded
+        # does not leave an empty file behind
+        header = dump_json(header_dict)
+        with open(fname, "wb") as f:
+            f.write(header)
+
+    def prepare_analyser(self, commands):
+        self._interface.send_commands(commands)
+        return self._interface.get_acquisition_settings()
 
     def run_measurement(self, mconfig):
         measurement = Measurement(mconfig)
-        log.info("Running measurement: {}".format(
-            measurement._tag))
-
-        log.info("Preparing spectrum analyser")
-        self._interface.send_commands(mconfig["spectrumAnalyserScpi"])
-
-        sampling_rate = self._interface.get_sampling_rate()
-        log.info("Sampling rate: {}".format(str(sampling_rate)))
-
-        analysis_bandwidth = self._interface.get_analysis_bandwidth()
-        log.info("Analysis bandwidth: {}".format(str(analysis_bandwidth)))
-
-        scaling_level = self._interface.get_scaling()
-        log.info("Scaling level: {}".format(str(scaling_level)))
-        output_dir = "/".join((measurement._output_path, time.strftime("%Y%m%d-%H%M%S/")))
-        log.info("Output directory: {}".format(output_dir))
+        log.info("Running measurement: %s", measurement._tag)
+
+        # The analyser set up and the DADA buffer allocation involve
+        # different hardware so they are run concurrently
+        log.info("Preparing spectrum analyser and spectrometer")
+        spectrometer = self._get_spectrometer()
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            analyser_setup = pool.submit(
+                self.prepare_analyser, mconfig["spectrumAnalyserScpi"])
+            spectrometer_setup = pool.submit(spectrometer.configure)
+            sampling_rate_hz, analysis_bandwidth_hz, scaling_level = analyser_setup.result()
+            spectrometer_setup.result()
+
+        log.info("Sampling rate: %s Hz", sampling_rate_hz)
+        log.info("Analysis bandwidth: %s Hz", analysis_bandwidth_hz)
+        log.info("Scaling level: %s dBm", scaling_level)
+        output_dir = measurement._output_path / time.strftime("%Y%m%d-%H%M%S")
+        log.info("Output directory: %s", output_dir)
 
         try:
-            os.makedirs(output_dir)
-        except FileExistsError:
-            pass
+            output_dir.mkdir(parents=True, exist_ok=True)
         except Exception as error:
             log.exception("Cannot create output directory")
             raise error
-    
-        try:
-            os.chown(output_dir, 1000, 1000)
-        except Exception as error:
-            log.exception("Cannot CHOWN output directory to rfiops")
-            raise error
-
 
+        stat = output_dir.stat()
+        if (stat.st_uid, stat.st_gid) != (OUTPUT_UID, OUTPUT_GID):
+            try:
+                os.chown(output_dir, OUTPUT_UID, OUTPUT_GID)
+            except PermissionError:
+                log.debug("Not permitted to CHOWN output directory to rfiops, skipping")
+            except Exception as error:
+                log.exception("Cannot CHOWN output directory to rfiops")
+                raise error
 
-        # Calculate the required FFT length and number of accumulated
-        # spectra required to satisfy the resolution and integration
-        # time.
+        integration_time_s = measurement._integration_time_s
         fsconfig = self._config["firstStageChanneliser"]
         first_stage_nchans = fsconfig["numChannels"]
-        log.info("First stage channeliser Nchans: {}".format(
-            first_stage_nchans))
-        channel_bandwidth = sampling_rate / first_stage_nchans
-        log.info("First stage frequency resolution: {}".format(
-            channel_bandwidth))
-        fft_length = int((channel_bandwidth /
-            measurement._resolution).decompose().value)
-        # Round FFT length to next power of 2
-        fft_length = 2**((fft_length-1).bit_length())
-        if fft_length > MAX_FFT_LENGTH:
-            message = "Resolution exceeds maximum FFT length ({} pts)".format(MAX_FFT_LENGTH)
-            log.error(message)
-            raise Exception(message)
-        
-        log.info("Desired second stage channeliser frequency resolution: {}".format(
-            measurement._resolution))
-        log.info("Second stage channeliser Nchans: {}".format(
-            fft_length))
-        actual_resolution = channel_bandwidth / fft_length
-        log.info("Actual second stage frequency resolution: {}".format(
-            actual_resolution))
-        # The number of spectra is rounded up to the next whole
-        # number
-        naccumulate = int(np.ceil(measurement._integration_time
-            * actual_resolution).decompose().value)
-        log.info("Second stage number of spectra to accumulate: {}".format(
-            naccumulate))
-        actual_integration_time = (naccumulate / actual_resolution).decompose()
-        log.info("Actual integration time: {}".format(actual_integration_time))
-        total_nchans = first_stage_nchans * fft_length
-        log.info("Total number of channels: {}".format(
-            total_nchans))
-
-        spectrometer = Spectrometer()
-        spectrometer.configure()
-        frequencies = measurement.get_centre_frequencies(analysis_bandwidth)
+        log.info("First stage channeliser Nchans: %s", first_stage_nchans)
+        plan = measurement.plan(sampling_rate_hz, first_stage_nchans)
+        fft_length = plan.fft_length
+        naccumulate = plan.naccumulate
+        total_nchans = plan.total_nchans
+        log.info("First stage frequency resolution: %s Hz", plan.channel_bandwidth_hz)
+        log.info("Desired second stage channeliser frequency resolution: %s Hz",
+                 measurement._resolution_hz)
+        log.info("Second stage channeliser Nchans: %s", fft_length)
+        log.info("Actual second stage frequency resolution: %s Hz",
+                 plan.actual_resolution_hz)
+        log.info("Second stage number of spectra to accumulate: %s", naccumulate)
+        log.info("Actual integration time: %s s", plan.actual_integration_time_s)
+        log.info("Total number of channels: %s", total_nchans)
+
+        # Values that are constant over the sweep are converted once here
+        actual_integration_time_ms = plan.actual_integration_time_s * 1e3
+        frequencies = measurement.get_centre_frequencies(analysis_bandwidth_hz)
         for frequency in frequencies:
-            log.info(("Preparing for {:0.01f} measurement with "
-                      "centre frequency {:0.03f}").format(
-                      measurement._integration_time, frequency))
+            log.info("Preparing for %0.01f s measurement with "
+                     "centre frequency %0.03f Hz",
+                     integration_time_s, frequency)
             try:
                 self._interface.set_centre_frequency(frequency)
             except DataOutOfRangeException:
                 log.error("Requested frequency outside of valid range")
                 log.warning("Skipping remaining frequencies in current range")
                 break
-            actual_frequency = self._interface.get_centre_frequency()
-            log.info("Actual centre frequency set: {}".format(
-                str(actual_frequency)))
+            actual_frequency_hz = self._interface.get_centre_frequency()
+            log.info("Actual centre frequency set: %s Hz", actual_frequency_hz)
             timestamp = int(time.time() * 1000)
-            filename_stem = "{}/{}_{:0.05}_{}".format(
-                output_dir,
+            filename_stem = "{}_{:0.05}_{}".format(
                 measurement._tag,
-                actual_frequency.to(u.MHz).value,
+                actual_frequency_hz / 1e6,
                 timestamp)
-            data_fname = "{}.npy".format(filename_stem)
-            header_fname = "{}.rfi".format(filename_stem)
-            self.write_header(header_fname, actual_frequency, sampling_rate, total_nchans,
-                              actual_integration_time, timestamp, measurement._tag)
+            data_fname = output_dir / "{}.npy".format(filename_stem)
+            header_fname = output_dir / "{}.rfi".format(filename_stem)
+            self.write_header(str(header_fname), actual_frequency_hz, sampling_rate_hz,
+                              analysis_bandwidth_hz, total_nchans,
+                              actual_integration_time_ms, timestamp, measurement._tag)
             log.info("Starting recording system")
-            spectrometer.record(first_stage_nchans, fft_length, naccumulate, data_fname, scaling_level)
+            spectrometer.record(first_stage_nchans, fft_length, naccumulate, str(data_fname), scaling_level)
             log.info("Recording done")
             log.info("Measurement complete")
 
+    def _get_spectrometer(self):
+        # The spectrometer and its DADA buffer are kept until close()
+        # rather than reallocated for every measurement
+        if self._spectrometer is None:
+            self._spectrometer = Spectrometer(self._config.get("captureNetwork"))
+        return self._spectrometer
+
+    def close(self):
+        if self._spectrometer is not None:
+            self._spectrometer.close()
+            self._spectrometer = None
+
     def run_all_measurements(self):
-        for measurement_config in self._config["measurementParameters"]:
-            try:
-                self.run_measurement(measurement_config)
-            except Exception as error:
-                log.error("Measurement failed with error '{}', skipping to next measurement".format(
-                    str(error)))
+        try:
+            for measurement_config in self._config["measurementParameters"]:
+                try:
+                    self.run_measurement(measurement_config)
+                except Exception as error:
+                    log.error("Measurement failed with error '%s', skipping to next measurement",
+                              error)
+        finally:
+            self.close()
+
+
+def _load_cached_config(cache_file, key):
+    try:
+        with open(cache_file, "r") as f:
+            cached = json.load(f)
+        cached_key = tuple(cached["key"])
+        config = cached["config"]
+    except FileNotFoundError:
+        return None
+    except Exception as error:
+        log.debug("Ignoring unreadable configuration cache %s: %s",
+                  cache_file, error)
+        return None
+    if cached_key != key:
+        return None
+    return config
+
+
+def _store_cached_config(cache_file, key, config):
+    # A plain JSON sidecar cannot execute code when loaded, configurations
+    # that do not survive the round trip unchanged are not cached
+    try:
+        data = json.dumps({"key": list(key), "config": config})
+    except (TypeError, ValueError) as error:
+        log.debug("Configuration not cacheable as JSON: %s", error)
+        return
+    if json.loads(data)["config"] != config:
+        log.debug("Configuration not cacheable as JSON, skipping cache")
+        return
+    tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+    try:
+        with open(tmp_file, "w") as f:
+            f.write(data)
+        os.replace(tmp_file, cache_file)
+    except Exception as error:
+        log.debug("Unable to write configuration cache %s: %s",
+                  cache_file, error)
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
 
 
 def parse_config(config_file):
-    log.info("Parsing configuration from file: {}".format(config_file))
+    log.info("Parsing configuration from file: %s", config_file)
+    # The parsed configuration is cached next to the source file and
+    # reused for as long as the source is unchanged
+    stat = os.stat(config_file)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cache_file = config_file + CONFIG_CACHE_SUFFIX
+    config = _load_cached_config(cache_file, key)
+    if config is not None:
+        log.debug("Using cached config: %s", config)
+        return config
     with open(config_file, "r") as f:
         try:
-            config = yaml.full_load(f)
+            config = yaml.load(f, Loader=YamlLoader)
         except Exception as error:
             log.exception("Error during configuration file load")
             raise error
         else:
-            log.debug("Parsed config: {}".format(config))
-            return config
+            log.debug("Parsed config: %s", config)
+    _store_cached_config(cache_file, key, config)
+    return config
 
 
 def main(config_file, dry_run):
@@ -533,15 +1000,15 @@ if __name__ == "__main__":
         formatter = logging.Formatter("[ %(levelname)s - %(asctime)s - %(name)s - %(filename)s:%(lineno)s] %(message)s")
         fh.setFormatter(formatter)
         log.addHandler(fh)
-        log.info("Log file: {}".format(log_file))
+        log.info("Log file: %s", log_file)
 
     try:
         main(args.config, args.dry_run)
     except KeyboardInterrupt:
         log.warning("User Ctrl-C interrupt")
     except Exception as error:
-        log.error("Exception '{}' propagated to top of stack, cleaning up DADA buffers and exiting.".format(
-            str(error)))
+        log.error("Exception '%s' propagated to top of stack, cleaning up DADA buffers and exiting.",
+                  error)
     finally:
         log.info("Cleaning up shared memory")
         try:
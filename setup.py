@@ -11,10 +11,13 @@ setup(name='rfi_chamber',
       install_requires=[
           'pyvisa',
           'pyvisa-py',
-          'pyyaml',
+          'pyyaml>=5.1',
           'coloredlogs',
           'astropy'
       ],
+      extras_require={
+          'fast': ['orjson']
+      },
       dependency_links=[
       ],
       zip_safe=False)